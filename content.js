@@ -517,52 +517,16 @@ class TokenPredictor {
     
     try {
       console.log('Predicting token:', { context, tokenIndex });
-      
-      // First, get the original tokenization to find the correct position
-      const tokenizeResponse = await fetch('http://localhost:5001/tokenize_display', {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ text: context })
-      });
-      
-      if (!tokenizeResponse.ok) {
-        throw new Error(`Tokenization error: ${tokenizeResponse.status}`);
-      }
-      
-      const tokenizeResult = await tokenizeResponse.json();
-      console.log('Tokenize result:', tokenizeResult);
-      
-      // Find the original token position for this display token
-      let originalPosition = -1;
-      if (tokenizeResult.token_positions && tokenIndex < tokenizeResult.token_positions.length) {
-        const tokenInfo = tokenizeResult.token_positions[tokenIndex];
-        console.log('Token info:', tokenInfo);
-        
-        // Find this token in the original tokenization
-        const originalTokens = tokenizeResult.original_tokens || [];
-        console.log('Original tokens:', originalTokens);
-        
-        for (let i = 0; i < originalTokens.length; i++) {
-          if (originalTokens[i] === tokenInfo.original_token) {
-            originalPosition = i;
-            break;
-          }
-        }
-      }
-      
-      console.log('Original position:', originalPosition);
-      
-      if (originalPosition === -1) {
-        throw new Error('Could not find original token position');
-      }
-      
-      // Now predict using the correct position
-      const response = await fetch('http://localhost:5001/predict_tokens', {
+
+      // Single fused request: the server tokenizes once, resolves the
+      // display token index to its original position and predicts in one
+      // round trip (this used to be two sequential fetches)
+      const response = await fetch('http://localhost:5001/tokenize_and_predict', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
           text: context,
-          masked_positions: [originalPosition]
+          token_index: tokenIndex
         })
       });
       
@@ -3,7 +3,9 @@
 Simple test to verify tokenization is working correctly.
 """
 
-import math
+import sys
+
+import numpy as np
 from transformers import AutoTokenizer
 
 def test_tokenization():
@@ -13,7 +15,8 @@ def test_tokenization():
     
     # Load tokenizer
     try:
-        tokenizer = AutoTokenizer.from_pretrained('gpt2')
+        tokenizer = AutoTokenizer.from_pretrained('gpt2', use_fast=True)
+        assert tokenizer.is_fast, "Expected the Rust-backed fast tokenizer"
         print(f"✅ Tokenizer loaded successfully!")
         print(f"Vocabulary size: {tokenizer.vocab_size}")
     except Exception as e:
@@ -32,11 +35,15 @@ def test_tokenization():
     
     print("\n📊 Tokenization Results:")
     print("-" * 50)
-    
-    for text in test_cases:
-        tokens = tokenizer.encode(text)
-        decoded_tokens = [tokenizer.decode([t]) for t in tokens]
-        
+
+    # Batch-encode all test cases in one tokenizer call instead of one
+    # encode() per sentence - amortizes the Python<->Rust round trip
+    encoded = tokenizer(test_cases, add_special_tokens=True)
+    all_token_ids = encoded['input_ids']
+    # One convert_ids_to_tokens call per sequence instead of one decode per token
+    all_decoded_tokens = [tokenizer.convert_ids_to_tokens(ids) for ids in all_token_ids]
+
+    for text, tokens, decoded_tokens in zip(test_cases, all_token_ids, all_decoded_tokens):
         print(f"\nInput: '{text}'")
         print(f"Tokens: {tokens}")
         print(f"Decoded: {decoded_tokens}")
@@ -45,15 +52,20 @@ def test_tokenization():
         print(f"Match: {text == tokenizer.decode(tokens)}")
         
         # Show logarithmic token IDs and color mapping
-        print("Logarithmic Token IDs and Color Mapping:")
+        # Vectorize the log/normalize/hue math with NumPy so the arithmetic
+        # runs as C loops instead of per-token Python bytecode
+        ids = np.asarray(tokens, dtype=np.int64)
+        log_ids = np.log10(ids + 1)
+        max_log_id = 5.0
+        normalized = np.minimum(log_ids / max_log_id, 1.0)
+        hues = (1 - normalized) * 240  # Blue to red
+        # Buffer the per-token lines and emit them with one write instead
+        # of one flushing print per token
+        lines = ["Logarithmic Token IDs and Color Mapping:"]
         for i, token_id in enumerate(tokens):
-            log_id = math.log10(token_id + 1)
-            # Calculate color based on token ID log value
-            max_log_id = 5.0
-            normalized = min(log_id / max_log_id, 1)
-            hue = (1 - normalized) * 240  # Blue to red
-            color_desc = "Blue" if normalized < 0.3 else "Green" if normalized < 0.7 else "Red"
-            print(f"  {decoded_tokens[i]} -> ID: {token_id} -> log₁₀: {log_id:.2f} -> {color_desc} (hue: {hue:.0f}°)")
+            color_desc = "Blue" if normalized[i] < 0.3 else "Green" if normalized[i] < 0.7 else "Red"
+            lines.append(f"  {decoded_tokens[i]} -> ID: {token_id} -> log₁₀: {log_ids[i]:.2f} -> {color_desc} (hue: {hues[i]:.0f}°)")
+        sys.stdout.write('\n'.join(lines) + '\n')
 
 if __name__ == "__main__":
     test_tokenization()
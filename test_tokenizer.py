@@ -4,26 +4,190 @@ Test script to verify tokenization works correctly using the same logic as the C
 This script processes test.html and generates output.html with tokenized text.
 """
 
+import os
 import re
 import json
 import math
+import functools
+
+# Let the Rust tokenizer fan batch encodes out across its thread pool
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "true")
+
+import numpy as np
 from pathlib import Path
+from html.parser import HTMLParser
 from transformers import AutoTokenizer
 import argparse
 
 
+def _compute_color_components(log_ids):
+    """Pure arithmetic behind the color mapping: normalized value, hue, opacity."""
+    normalized = np.minimum(log_ids / 5.0, 1.0)
+    hue = (1.0 - normalized) * 240.0
+    opacity = normalized * 0.1
+    return normalized, hue, opacity
+
+
+try:
+    # JIT-compile the numeric kernel to a native SIMD loop when numba is
+    # installed; the NumPy version above is the fallback
+    import numba
+    _compute_color_components = numba.njit(cache=True)(_compute_color_components)
+except ImportError:
+    pass
+
+
+@functools.lru_cache(maxsize=1024)
+def _token_color_from_log_id(log_token_id):
+    """Cached hsl() string for a (rounded) token ID log value."""
+    max_log_id = 5.0
+    normalized = min(log_token_id / max_log_id, 1)
+    hue = (1 - normalized) * 240  # 240 is blue, 0 is red
+    return f"hsl({hue}, 80%, 50%)"
+
+
+@functools.lru_cache(maxsize=1024)
+def _background_color_from_log_id(log_token_id):
+    """Cached hsla() background string for a (rounded) token ID log value."""
+    max_log_id = 5.0
+    normalized = min(log_token_id / max_log_id, 1)
+    opacity = normalized * 0.1  # Very subtle background
+    hue = (1 - normalized) * 240
+    return f"hsla({hue}, 20%, 90%, {opacity})"
+
+
+@functools.lru_cache(maxsize=1024)
+def _token_count_color_from_log_id(log_token_id):
+    """Cached superscript hsl() string for a (rounded) token ID log value."""
+    max_log_id = 5.0
+    normalized = min(log_token_id / max_log_id, 1)
+    hue = (1 - normalized) * 240
+    return f"hsl({hue}, 90%, 40%)"
+
+
+# Single-line span template - one .format() + list append per token instead
+# of a multi-line f-string with repeated concatenations
+_SPAN_TMPL = (
+    '<span class="individual-token" style="color: {}; background-color: {}; '
+    'padding: 1px 2px; margin: 0 1px; border-radius: 3px; display: inline-block;">'
+    '{}<sup class="token-id-superscript" style="color: {}; font-size: 0.6em; '
+    'margin-left: 1px; opacity: 0.9;" title="{}">{}</sup></span>'
+)
+
+# Injected once per output document; built a single time at import
+_CSS_STYLES = """
+        <style>
+        .individual-token {
+            display: inline-block;
+            padding: 1px 2px;
+            margin: 0 1px;
+            border-radius: 3px;
+            transition: all 0.2s ease;
+        }
+        .individual-token:hover {
+            transform: scale(1.05);
+            box-shadow: 0 2px 4px rgba(0, 0, 0, 0.1);
+        }
+        .token-index-superscript {
+            font-size: 0.6em;
+            font-weight: 600;
+            margin-left: 1px;
+            opacity: 0.9;
+            vertical-align: super;
+            line-height: 0;
+            position: relative;
+            top: -0.2em;
+        }
+        .text-token-processed {
+            position: relative;
+            display: inline;
+        }
+        </style>
+        """
+
+
+class _TokenizingHTMLParser(HTMLParser):
+    """Single-pass HTML walker that keeps markup verbatim and collects text nodes.
+
+    Markup is appended to `parts` as raw strings; each text node worth
+    tokenizing is recorded as an integer index into `texts` so the caller can
+    tokenize everything in one go and splice the rendered spans back in.
+    """
+
+    SKIP_TAGS = {'script', 'style'}
+    # One compiled pattern covering the entity- and CSS-looking prefixes the
+    # old startswith tuple checks skipped, without allocating stripped copies
+    SKIP_RE = re.compile(r'^\s*(?:[<&]|body|font|max|margin|padding)')
+
+    def __init__(self, css_styles):
+        super().__init__(convert_charrefs=False)
+        self.parts = []
+        self.texts = []
+        self.css_styles = css_styles
+        self._skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        self.parts.append(self.get_starttag_text())
+        if tag in self.SKIP_TAGS:
+            self._skip_depth += 1
+
+    def handle_startendtag(self, tag, attrs):
+        self.parts.append(self.get_starttag_text())
+
+    def handle_endtag(self, tag):
+        if tag == 'head' and self.css_styles is not None:
+            # Insert our styles just before </head>
+            self.parts.append(self.css_styles)
+            self.css_styles = None
+        self.parts.append(f'</{tag}>')
+        if tag in self.SKIP_TAGS and self._skip_depth:
+            self._skip_depth -= 1
+
+    def handle_data(self, data):
+        if self._skip_depth == 0 and self._should_tokenize(data):
+            self.parts.append(len(self.texts))
+            self.texts.append(data)
+        else:
+            self.parts.append(data)
+
+    def _should_tokenize(self, text):
+        if not text or text.isspace():
+            return False
+        return self.SKIP_RE.match(text) is None
+
+    def handle_entityref(self, name):
+        self.parts.append(f'&{name};')
+
+    def handle_charref(self, name):
+        self.parts.append(f'&#{name};')
+
+    def handle_comment(self, data):
+        self.parts.append(f'<!--{data}-->')
+
+    def handle_decl(self, decl):
+        self.parts.append(f'<!{decl}>')
+
+    def handle_pi(self, data):
+        self.parts.append(f'<?{data}>')
+
+
 class TokenizerTester:
-    def __init__(self, model_name="gpt2"):
+    def __init__(self, model_name="gpt2", verbose=False):
         """Initialize the tokenizer tester with a specific model."""
         self.model_name = model_name
+        self.verbose = verbose
         self.tokenizer = None
+        self._color_cache = None
+        self._token_count = 0
         self.load_tokenizer()
     
     def load_tokenizer(self):
         """Load the tokenizer model."""
         try:
             print(f"Loading tokenizer: {self.model_name}")
-            self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+            self.tokenizer = AutoTokenizer.from_pretrained(self.model_name, use_fast=True)
+            # The slow Python tokenizer is 10-100x slower; insist on Rust
+            assert self.tokenizer.is_fast, "Expected the Rust-backed fast tokenizer"
             print(f"✅ Tokenizer loaded successfully!")
             print(f"Vocabulary size: {self.tokenizer.vocab_size}")
             
@@ -32,30 +196,65 @@ class TokenizerTester:
             tokens = self.tokenizer.encode(test_text)
             print(f"Test tokenization: {tokens} ({len(tokens)} tokens)")
             print(f"Reconstructed: '{self.tokenizer.decode(tokens)}'")
-            
+
+            # Cache encode results by content - HTML documents repeat the
+            # same short strings (navigation, headings) constantly
+            self._encode_cached = functools.lru_cache(maxsize=8192)(
+                lambda text: tuple(self.tokenizer.encode(text))
+            )
+            self._build_color_cache()
+
+            # Bind the fast path directly - callers skip the per-call
+            # "is the tokenizer loaded?" branch entirely
+            self.tokenize_text = self._tokenize_fast
+
         except Exception as e:
             print(f"❌ Failed to load tokenizer: {e}")
             print("Using fallback word-based tokenization")
             self.tokenizer = None
-    
-    def tokenize_text(self, text):
-        """Tokenize text using the loaded tokenizer or fallback."""
-        if self.tokenizer:
-            try:
-                # Use the tokenizer to encode the text
-                tokens = self.tokenizer.encode(text)
+            self.tokenize_text = self.fallback_tokenize
+
+    def _build_color_cache(self):
+        """Precompute color strings for every token ID in the vocabulary.
+
+        The span colors are a pure function of the token ID and IDs repeat
+        heavily within a document, so compute each vocab entry exactly once
+        and turn the per-token work in process_text_node into a list lookup.
+        """
+        vocab_size = len(self.tokenizer)
+        log_ids = np.log10(np.arange(vocab_size, dtype=np.float64) + 1)
+        _, hues, opacities = _compute_color_components(log_ids)
+        self._color_cache = [
+            (
+                f"hsl({hue}, 80%, 50%)",
+                f"hsla({hue}, 20%, 90%, {opacity})",
+                f"hsl({hue}, 90%, 40%)",
+                f"{log_id:.2f}",
+            )
+            for hue, opacity, log_id in zip(
+                hues.tolist(), opacities.tolist(), log_ids.tolist()
+            )
+        ]
+
+
+    def _tokenize_fast(self, text):
+        """Tokenize text with the loaded tokenizer; bound as tokenize_text."""
+        try:
+            # Use the tokenizer to encode the text (memoized by content)
+            tokens = list(self._encode_cached(text))
+            if self.verbose:
+                # Debug output only - this fires once per text node
                 print(f"Tokenizing '{text}' -> {len(tokens)} tokens: {tokens[:10]}{'...' if len(tokens) > 10 else ''}")
-                return tokens
-            except Exception as e:
-                print(f"Tokenizer error: {e}")
-                return self.fallback_tokenize(text)
-        else:
+            return tokens
+        except Exception as e:
+            print(f"Tokenizer error: {e}")
             return self.fallback_tokenize(text)
     
     def fallback_tokenize(self, text):
         """Fallback word-based tokenization."""
         words = text.split()
-        print(f"Fallback tokenizing '{text}' -> {len(words)} words: {words}")
+        if self.verbose:
+            print(f"Fallback tokenizing '{text}' -> {len(words)} words: {words}")
         return words
     
     def get_token_color(self, token_index, total_tokens):
@@ -87,47 +286,41 @@ class TokenizerTester:
     
     def get_token_color_from_log_id(self, log_token_id):
         """Get color based on token ID log value."""
-        # Typical range: 0.0 (token ID 0) to ~4.7 (token ID ~50,000)
-        max_log_id = 5.0  # Adjust based on tokenizer's vocabulary size
-        normalized = min(log_token_id / max_log_id, 1)
-        
-        # Create a smooth color gradient from blue (low ID) to red (high ID)
-        hue = (1 - normalized) * 240  # 240 is blue, 0 is red
-        saturation = 80
-        lightness = 50
-        
-        return f"hsl({hue}, {saturation}%, {lightness}%)"
-    
+        # Typical range: 0.0 (token ID 0) to ~4.7 (token ID ~50,000).
+        # Round to 2 decimals so the LRU cache stays small and hits often.
+        return _token_color_from_log_id(round(log_token_id, 2))
+
     def get_background_color_from_log_id(self, log_token_id):
         """Get background color based on token ID log value."""
-        max_log_id = 5.0
-        normalized = min(log_token_id / max_log_id, 1)
-        
-        opacity = normalized * 0.1  # Very subtle background
-        hue = (1 - normalized) * 240
-        
-        return f"hsla({hue}, 20%, 90%, {opacity})"
-    
+        return _background_color_from_log_id(round(log_token_id, 2))
+
     def get_token_count_color_from_log_id(self, log_token_id):
         """Get superscript color based on token ID log value."""
-        max_log_id = 5.0
-        normalized = min(log_token_id / max_log_id, 1)
-        
-        # Use a more saturated color for the superscript
-        hue = (1 - normalized) * 240
-        saturation = 90
-        lightness = 40
-        
-        return f"hsl({hue}, {saturation}%, {lightness}%)"
+        return _token_count_color_from_log_id(round(log_token_id, 2))
     
-    def process_text_node(self, text):
-        """Process a text node and return HTML with tokenized content."""
+    def process_text_node(self, text, tokens=None):
+        """Process a text node and return HTML with tokenized content.
+
+        `tokens` may be passed in when the caller already batch-encoded the
+        text along with other nodes.
+        """
         if not text.strip():
             return text
-        
-        # Tokenize the text
-        tokens = self.tokenize_text(text)
-        
+
+        # Tokenize the text unless the caller did it already
+        if tokens is None:
+            tokens = self.tokenize_text(text)
+        self._token_count += len(tokens)
+
+        if tokens and isinstance(tokens[0], int) and self.tokenizer:
+            # Decode all tokens in one batched call instead of one
+            # tokenizer.decode([t]) round trip per token
+            token_texts = self.tokenizer.batch_decode(
+                [[t] for t in tokens], clean_up_tokenization_spaces=False
+            )
+        else:
+            token_texts = None
+
         # Create HTML spans for each token
         token_spans = []
         for i, token in enumerate(tokens):
@@ -135,7 +328,7 @@ class TokenizerTester:
             
             # Decode token if it's a token ID
             if isinstance(token, int) and self.tokenizer:
-                token_text = self.tokenizer.decode([token])
+                token_text = token_texts[i]
                 token_id = token
             else:
                 token_text = str(token)
@@ -144,8 +337,11 @@ class TokenizerTester:
             # Clean up the token text (remove extra spaces)
             token_text = token_text.strip()
             
-            # Calculate colors based on token ID log value
-            if token_id is not None:
+            # Look up colors precomputed per token ID at load time
+            if token_id is not None and self._color_cache and token_id < len(self._color_cache):
+                color, bg_color, superscript_color, display_id = self._color_cache[token_id]
+                title_text = f"Token ID: {token_id}"
+            elif token_id is not None:
                 log_token_id = math.log10(token_id + 1)  # +1 to avoid log(0)
                 color = self.get_token_color_from_log_id(log_token_id)
                 bg_color = self.get_background_color_from_log_id(log_token_id)
@@ -160,109 +356,57 @@ class TokenizerTester:
                 display_id = str(token_index)
                 title_text = f"Position: {token_index}"
             
-            token_span = f'''<span class="individual-token" style="color: {color}; background-color: {bg_color}; padding: 1px 2px; margin: 0 1px; border-radius: 3px; display: inline-block;">
-                {token_text}<sup class="token-id-superscript" style="color: {superscript_color}; font-size: 0.6em; margin-left: 1px; opacity: 0.9;" title="{title_text}">{display_id}</sup>
-            </span>'''
-            token_spans.append(token_span)
+            token_spans.append(_SPAN_TMPL.format(
+                color, bg_color, token_text, superscript_color, title_text, display_id
+            ))
         
         return ''.join(token_spans)
     
     def process_html_file(self, input_file, output_file):
         """Process an HTML file and generate output with tokenized text."""
         print(f"Processing {input_file} -> {output_file}")
-        
-        # Read the input file
+        self._token_count = 0
+
+        # Walk the document once with an HTML parser instead of running a
+        # '>text<' regex pass plus one extra regex pass per element type -
+        # each text node is seen (and tokenized) exactly once
+        parser = _TokenizingHTMLParser(_CSS_STYLES)
         with open(input_file, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        # Add CSS styles
-        css_styles = """
-        <style>
-        .individual-token {
-            display: inline-block;
-            padding: 1px 2px;
-            margin: 0 1px;
-            border-radius: 3px;
-            transition: all 0.2s ease;
-        }
-        .individual-token:hover {
-            transform: scale(1.05);
-            box-shadow: 0 2px 4px rgba(0, 0, 0, 0.1);
-        }
-        .token-index-superscript {
-            font-size: 0.6em;
-            font-weight: 600;
-            margin-left: 1px;
-            opacity: 0.9;
-            vertical-align: super;
-            line-height: 0;
-            position: relative;
-            top: -0.2em;
-        }
-        .text-token-processed {
-            position: relative;
-            display: inline;
-        }
-        </style>
-        """
-        
-        # Insert CSS before </head>
-        if '</head>' in content:
-            content = content.replace('</head>', css_styles + '</head>')
+            # Stream the document through the parser in fixed-size chunks
+            # instead of materializing the whole file as one string
+            while True:
+                chunk = f.read(1 << 20)
+                if not chunk:
+                    break
+                parser.feed(chunk)
+        parser.close()
+        if parser.css_styles is not None:
+            # Document had no </head> - prepend the styles as before
+            parser.parts.insert(0, parser.css_styles)
+
+        # Encode every collected text node in one batch call (dispatched in
+        # parallel by the fast tokenizer) and render the spans from the ids
+        if self.tokenizer and parser.texts:
+            all_ids = self.tokenizer(parser.texts, add_special_tokens=False)['input_ids']
+            rendered = [
+                self.process_text_node(text, tokens=ids)
+                for text, ids in zip(parser.texts, all_ids)
+            ]
         else:
-            content = css_styles + content
-        
-        # Process text content more carefully
-        def process_text_content(match):
-            text = match.group(1)
-            if text.strip() and not text.startswith((' ', '\t', '\n')):
-                # Only process meaningful text content
-                return self.process_text_node(text)
-            return text
-        
-        # Process text content more carefully - only process actual text content, not HTML
-        # Find text that's between HTML tags but not inside them
-        def process_text_in_html(match):
-            text = match.group(1)
-            # Only process if it's not HTML tags or whitespace
-            if text.strip() and not text.strip().startswith(('<', '&')) and not text.strip().startswith(('body', 'font', 'max', 'margin', 'padding')):
-                return self.process_text_node(text)
-            return text
-        
-        # Process text between tags more carefully
-        text_pattern = r'>([^<>]+)<'
-        processed_content = re.sub(text_pattern, lambda m: '>' + process_text_in_html(m) + '<', content)
-        
-        # Also process specific text elements
-        element_patterns = [
-            (r'<title>([^<]+)</title>', r'<title>\1</title>'),
-            (r'<h1[^>]*>([^<]+)</h1>', r'<h1>\1</h1>'),
-            (r'<h2[^>]*>([^<]+)</h2>', r'<h2>\1</h2>'),
-            (r'<h3[^>]*>([^<]+)</h3>', r'<h3>\1</h3>'),
-            (r'<p[^>]*>([^<]+)</p>', r'<p>\1</p>'),
-            (r'<li[^>]*>([^<]+)</li>', r'<li>\1</li>'),
-        ]
-        
-        for pattern, replacement in element_patterns:
-            def replace_func(match):
-                text = match.group(1)
-                if text.strip():
-                    tokenized = self.process_text_node(text)
-                    return replacement.replace(r'\1', tokenized)
-                return replacement.replace(r'\1', text)
-            
-            processed_content = re.sub(pattern, replace_func, processed_content)
-        
-        # Write the output file
-        with open(output_file, 'w', encoding='utf-8') as f:
-            f.write(processed_content)
-        
+            rendered = [self.process_text_node(text) for text in parser.texts]
+
+        # Stream the parts straight into a large-buffered file handle rather
+        # than materializing the whole processed document as one string
+        with open(output_file, 'w', encoding='utf-8', buffering=1 << 20) as f:
+            for part in parser.parts:
+                f.write(rendered[part] if isinstance(part, int) else part)
+
         print(f"✅ Output written to {output_file}")
         
-        # Print statistics
-        total_tokens = len(self.tokenize_text(content))
-        print(f"Total tokens in document: {total_tokens}")
-        
+        # Print statistics - counted while processing instead of
+        # re-tokenizing the entire raw HTML just for this number
+        print(f"Total tokens in document: {self._token_count}")
+
         # Print some examples
         print("\n📊 Tokenization Examples:")
         examples = [
@@ -271,14 +415,18 @@ class TokenizerTester:
             "The quick brown fox jumps over the lazy dog.",
             "Medium Complexity Text"
         ]
-        
-        for example in examples:
-            tokens = self.tokenize_text(example)
-            if self.tokenizer and isinstance(tokens[0], int):
-                # Decode tokens to show actual text
-                decoded_tokens = [self.tokenizer.decode([t]) for t in tokens]
+
+        if self.tokenizer:
+            # Batch-encode the examples in one tokenizer call
+            all_example_ids = self.tokenizer(examples)['input_ids']
+            for example, tokens in zip(examples, all_example_ids):
+                decoded_tokens = self.tokenizer.batch_decode(
+                    [[t] for t in tokens], clean_up_tokenization_spaces=False
+                )
                 print(f"'{example}' -> {len(tokens)} tokens: {decoded_tokens}")
-            else:
+        else:
+            for example in examples:
+                tokens = self.tokenize_text(example)
                 print(f"'{example}' -> {len(tokens)} tokens: {tokens[:5]}{'...' if len(tokens) > 5 else ''}")
 
 def main():
@@ -286,11 +434,13 @@ def main():
     parser.add_argument('--model', default='gpt2', help='Tokenizer model to use')
     parser.add_argument('--input', default='test.html', help='Input HTML file')
     parser.add_argument('--output', default='output.html', help='Output HTML file')
-    
+    parser.add_argument('--verbose', action='store_true',
+                        help='Print per-text-node tokenization details')
+
     args = parser.parse_args()
-    
+
     # Create tester
-    tester = TokenizerTester(args.model)
+    tester = TokenizerTester(args.model, verbose=args.verbose)
     
     # Process the file
     input_path = Path(args.input)
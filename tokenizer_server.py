@@ -5,13 +5,22 @@ Provides tokenization services and masked language modeling using transformers
 Uses language-specific models: RoBERTa for English, BETO Cased for Spanish, XLM-RoBERTa for others
 """
 
+import functools
 import json
 import logging
+import os
+import queue
+import threading
+import time
+
+# Let the Rust tokenizers parallelize batch encodes; must be set before
+# transformers is imported or the library pins it to false under forking
+os.environ.setdefault('TOKENIZERS_PARALLELISM', 'true')
+
 from flask import Flask, request, jsonify, send_from_directory
 from flask_cors import CORS
 from transformers import AutoTokenizer, AutoModelForMaskedLM
 import torch
-import torch.nn.functional as F
 from langdetect import detect, LangDetectException
 
 # Set up logging
@@ -19,72 +28,399 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
-CORS(app)  # Enable CORS for Chrome extension
+# Scope CORS to the extension (override with ALLOWED_ORIGINS, comma
+# separated) and let browsers cache the preflight for a day so hovers
+# don't pay an OPTIONS round trip each time
+_allowed_origins = os.environ.get('ALLOWED_ORIGINS', 'chrome-extension://*').split(',')
+CORS(app, origins=_allowed_origins, max_age=86400)
+
+try:
+    import orjson
+
+    def ojsonify(payload, status=200):
+        """Serialize responses with orjson - several times faster than the
+        stdlib encoder on the large token-position payloads we return."""
+        return app.response_class(orjson.dumps(payload), status=status,
+                                  mimetype='application/json')
+except ImportError:
+    def ojsonify(payload, status=200):
+        """Fallback to Flask's jsonify when orjson isn't installed."""
+        response = jsonify(payload)
+        response.status_code = status
+        return response
+
+class LangModel:
+    """Per-language model bundle - slot attribute loads instead of nested
+    dict probes on every hot-path access."""
+
+    __slots__ = ('name', 'model', 'tokenizer', 'id_to_token', 'failed_at')
+
+    def __init__(self, name):
+        self.name = name
+        self.model = None
+        self.tokenizer = None
+        self.id_to_token = None
+        self.failed_at = None
+
 
 # Global models - we'll load multiple models
 models = {
-    'en': {'model': None, 'tokenizer': None, 'name': 'roberta-base'},
-    'es': {'model': None, 'tokenizer': None, 'name': 'dccuchile/bert-base-spanish-wwm-cased'},
-    'default': {'model': None, 'tokenizer': None, 'name': 'FacebookAI/xlm-roberta-base'}
+    'en': LangModel('roberta-base'),
+    'es': LangModel('dccuchile/bert-base-spanish-wwm-cased'),
+    'default': LangModel('FacebookAI/xlm-roberta-base')
 }
 
-def load_models():
-    """Load language-specific models"""
-    global models
+# Opt-in dynamic INT8 quantization for CPU serving (QUANTIZE=1)
+QUANTIZE = os.environ.get('QUANTIZE', '0') == '1'
+
+# Run CPU forwards under bfloat16 autocast (CPU_BF16=1). Mutually
+# exclusive with INT8 quantization, which already owns the GEMMs.
+_CPU_BF16 = os.environ.get('CPU_BF16', '0') == '1' and not QUANTIZE
+
+
+def prepare_model(model):
+    """Put a freshly loaded model into serving shape."""
+    model.eval()
+    for p in model.parameters():
+        p.requires_grad_(False)
     try:
-        logger.info("Loading language-specific models...")
-        
-        # Load English model (RoBERTa)
-        try:
-            logger.info("Loading RoBERTa for English...")
-            models['en']['tokenizer'] = AutoTokenizer.from_pretrained("roberta-base")
-            models['en']['model'] = AutoModelForMaskedLM.from_pretrained("roberta-base")
-            logger.info("✅ RoBERTa English model loaded successfully!")
-        except Exception as e:
-            logger.warning(f"Failed to load RoBERTa: {e}")
-        
-        # Load Spanish model (BETO Cased)
-        try:
-            logger.info("Loading BETO Cased for Spanish...")
-            models['es']['tokenizer'] = AutoTokenizer.from_pretrained("dccuchile/bert-base-spanish-wwm-cased")
-            models['es']['model'] = AutoModelForMaskedLM.from_pretrained("dccuchile/bert-base-spanish-wwm-cased")
-            logger.info("✅ BETO Cased Spanish model loaded successfully!")
-        except Exception as e:
-            logger.warning(f"Failed to load BETO Cased: {e}")
-        
-        # Load default multilingual model (XLM-RoBERTa)
+        # Fused scaled_dot_product_attention kernels with nested-tensor
+        # padding skip - a pure throughput win on the short sequences the
+        # extension sends
+        model = model.to_bettertransformer()
+        logger.info("Enabled BetterTransformer fastpath")
+    except Exception as e:
+        logger.info(f"BetterTransformer unavailable, using vanilla attention: {e}")
+    if torch.cuda.is_available():
+        # Migrate parameters once at load time; request handlers only move
+        # their (tiny) input tensors
+        model = model.half().cuda()
+    elif QUANTIZE:
         try:
-            logger.info("Loading XLM-RoBERTa for other languages...")
-            models['default']['tokenizer'] = AutoTokenizer.from_pretrained("FacebookAI/xlm-roberta-base")
-            models['default']['model'] = AutoModelForMaskedLM.from_pretrained("FacebookAI/xlm-roberta-base")
-            logger.info("✅ XLM-RoBERTa multilingual model loaded successfully!")
+            # int8 GEMMs; LayerNorm and embeddings stay FP32. Prefer the
+            # oneDNN-backed x86 engine (AVX-512 VNNI / AMX), then FBGEMM,
+            # then qnnpack on ARM - whichever this torch build supports
+            for engine in ('x86', 'fbgemm', 'qnnpack'):
+                if engine in torch.backends.quantized.supported_engines:
+                    torch.backends.quantized.engine = engine
+                    break
+            model = torch.quantization.quantize_dynamic(
+                model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+            logger.info(f"Applied dynamic INT8 quantization ({torch.backends.quantized.engine})")
         except Exception as e:
-            logger.warning(f"Failed to load XLM-RoBERTa: {e}")
-        
+            logger.warning(f"Dynamic quantization failed, serving FP32: {e}")
+    try:
+        # Fuse kernels and cut eager-mode dispatch overhead; dynamic=True
+        # keeps recompiles down across the varying sequence lengths
+        model = torch.compile(model, mode='reduce-overhead', dynamic=True)
+        logger.info("Compiled model forward with torch.compile")
+    except Exception as e:
+        logger.warning(f"torch.compile unavailable, running eager: {e}")
+    try:
+        # Pay the first-call compile/autotune cost at startup instead of on
+        # the first user request
+        device = next(iter(model.parameters()), torch.empty(0)).device
+        dummy = torch.zeros((1, 16), dtype=torch.long, device=device)
+        with torch.inference_mode():
+            model(input_ids=dummy, attention_mask=torch.ones_like(dummy))
+        logger.info("Prewarmed model forward")
+    except Exception as e:
+        logger.warning(f"Prewarm forward failed: {e}")
+    return model
+
+
+def _build_id_to_token(tokenizer):
+    """Materialize the full id -> token-string table once at load time.
+
+    Turns the per-candidate convert_ids_to_tokens call in the prediction
+    loop into a plain list index.
+    """
+    return tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+
+
+# One lock per language so a burst of first requests loads each model
+# exactly once without serializing unrelated languages
+_load_locks = {lang: threading.Lock() for lang in models}
+
+# How long to wait after a failed load before trying that language again.
+# In between, requests fall back to another model immediately instead of
+# re-running the download/timeout under the load lock.
+LOAD_RETRY_SECONDS = 300
+
+
+def _load_language(lang):
+    """Load one language's tokenizer, vocab table and model into the registry."""
+    entry = models[lang]
+    logger.info(f"Loading {entry.name} for '{lang}'...")
+    entry.tokenizer = AutoTokenizer.from_pretrained(entry.name, use_fast=True)
+    entry.id_to_token = _build_id_to_token(entry.tokenizer)
+    entry.model = prepare_model(AutoModelForMaskedLM.from_pretrained(entry.name))
+    logger.info(f"✅ {entry.name} loaded successfully! (vocab: {entry.tokenizer.vocab_size})")
+    # use_fast=True is only a request - surface it loudly if HF handed
+    # back the slow Python tokenizer, since the offset-based endpoints
+    # depend on the Rust implementation
+    if not getattr(entry.tokenizer, 'is_fast', False):
+        logger.warning(f"  {lang}: slow Python tokenizer in use - offset mappings unavailable")
+
+
+def _ensure_loaded(lang):
+    """Load a language on first use. Returns True if its model is ready.
+
+    A failed load is remembered on the entry so subsequent requests fall
+    back right away rather than repeating the attempt; after
+    LOAD_RETRY_SECONDS the next request tries again.
+    """
+    entry = models[lang]
+    if entry.model is not None:
+        return True
+    if entry.failed_at is not None and time.monotonic() - entry.failed_at < LOAD_RETRY_SECONDS:
+        return False
+    with _load_locks[lang]:
+        if entry.model is None:
+            if entry.failed_at is not None and time.monotonic() - entry.failed_at < LOAD_RETRY_SECONDS:
+                return False
+            try:
+                _load_language(lang)
+                entry.failed_at = None
+            except Exception as e:
+                entry.failed_at = time.monotonic()
+                logger.warning(f"Failed to load model for '{lang}': {e}")
+    return entry.model is not None
+
+
+def load_models():
+    """Eagerly load the languages named in CHROMA_LANGS (default: all).
+
+    Setting e.g. CHROMA_LANGS=en keeps startup RSS to one model for
+    monolingual browsing; the other languages load lazily on their first
+    request instead of up front.
+    """
+    try:
+        langs = os.environ.get('CHROMA_LANGS')
+        if langs:
+            eager = [l.strip() for l in langs.split(',') if l.strip() in models]
+        else:
+            eager = list(models)
+
+        logger.info(f"Loading language-specific models: {eager}")
+        for lang in eager:
+            _ensure_loaded(lang)
+
         # Check if at least one model loaded
-        loaded_models = [lang for lang, data in models.items() if data['model'] is not None]
+        loaded_models = [lang for lang, data in models.items() if data.model is not None]
         if not loaded_models:
             logger.error("No models loaded successfully!")
             return False
-        
+
         logger.info(f"Final setup - Loaded models: {loaded_models}")
-        for lang in loaded_models:
-            logger.info(f"  {lang}: {models[lang]['name']} (vocab: {models[lang]['tokenizer'].vocab_size})")
-        
         return True
-        
+
     except Exception as e:
         logger.error(f"Error loading models: {e}")
         return False
 
+# Micro-batching for MLM forwards: requests that arrive within a short
+# window share one padded forward pass instead of each paying a
+# batch-of-1 model call
+BATCH_MAX_SIZE = 16
+BATCH_WINDOW_MS = 8
+
+
+class _BatchItem:
+    """One queued sequence waiting for its slice of a batched forward."""
+
+    __slots__ = ('lang', 'token_ids', 'event', 'logits', 'error')
+
+    def __init__(self, lang, token_ids):
+        self.lang = lang
+        self.token_ids = token_ids
+        self.event = threading.Event()
+        self.logits = None
+        self.error = None
+
+
+_batch_queue = queue.Queue()
+
+# Staging buffers reused across batches (page-locked for the GPU path so
+# host-to-device copies can run non-blocking, plain for CPU so repeated
+# batches don't churn the allocator). Only the single batch worker thread
+# touches them, so no locking is needed.
+_staging = {}
+
+
+def _staging_buffers(rows, cols, pin_memory=False):
+    """Return reusable [rows, cols] id/mask buffers, growing them as needed."""
+    ids, mask = _staging.get(pin_memory, (None, None))
+    if ids is None or ids.size(0) < rows or ids.size(1) < cols:
+        alloc_rows = max(rows, BATCH_MAX_SIZE)
+        alloc_cols = max(cols, 128)
+        ids = torch.empty((alloc_rows, alloc_cols), dtype=torch.long, pin_memory=pin_memory)
+        mask = torch.empty((alloc_rows, alloc_cols), dtype=torch.long, pin_memory=pin_memory)
+        _staging[pin_memory] = (ids, mask)
+    return ids[:rows, :cols], mask[:rows, :cols]
+
+
+# Records when the previous batch's non_blocking host-to-device copies
+# were enqueued; the worker syncs on it before refilling the pinned
+# buffers so a backlogged queue can't overwrite copies still in flight
+_staging_copies_done = None
+
+
+def _run_batch(lang, group):
+    """Pad a group of sequences, run one forward, hand each its logits."""
+    tokenizer = models[lang].tokenizer
+    model = models[lang].model
+    pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+    max_len = max(len(item.token_ids) for item in group)
+    device = next(model.parameters()).device
+
+    global _staging_copies_done
+    if device.type == 'cuda' and _staging_copies_done is not None:
+        # Don't refill the pinned buffers until the previous batch's
+        # async host-to-device copies have drained out of them
+        _staging_copies_done.synchronize()
+
+    input_ids, attention_mask = _staging_buffers(
+        len(group), max_len, pin_memory=(device.type == 'cuda'))
+    input_ids.fill_(pad_id)
+    attention_mask.zero_()
+    for i, item in enumerate(group):
+        n = len(item.token_ids)
+        input_ids[i, :n] = torch.tensor(item.token_ids, dtype=torch.long)
+        attention_mask[i, :n] = 1
+
+    if device.type == 'cuda':
+        input_ids = input_ids.to(device, non_blocking=True)
+        attention_mask = attention_mask.to(device, non_blocking=True)
+        _staging_copies_done = torch.cuda.Event()
+        _staging_copies_done.record()
+        with torch.inference_mode(), torch.autocast('cuda', dtype=torch.float16):
+            outputs = model(input_ids=input_ids, attention_mask=attention_mask)
+    elif _CPU_BF16:
+        # BF16 halves the bytes every GEMM and softmax moves; top-k MLM
+        # predictions are robust to it, and the returned logits are
+        # upcast to FP32 downstream before probability math
+        with torch.inference_mode(), torch.autocast('cpu', dtype=torch.bfloat16):
+            outputs = model(input_ids=input_ids, attention_mask=attention_mask)
+    else:
+        with torch.inference_mode():
+            outputs = model(input_ids=input_ids, attention_mask=attention_mask)
+
+    for i, item in enumerate(group):
+        row = outputs.logits[i, :len(item.token_ids)]
+        # With reduce-overhead CUDA graphs the next replay reuses the same
+        # output buffers, so hand each request its own copy rather than a
+        # live view the next batch's forward could overwrite mid-read. The
+        # clone is stream-ordered ahead of the next forward, so it reads
+        # the buffer before any replay can clobber it.
+        item.logits = row.clone() if device.type == 'cuda' else row
+        item.event.set()
+
+
+def _batch_worker():
+    """Drain the queue in small time windows and batch per language model."""
+    while True:
+        items = [_batch_queue.get()]
+        deadline = time.monotonic() + BATCH_WINDOW_MS / 1000.0
+        while len(items) < BATCH_MAX_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                items.append(_batch_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        by_lang = {}
+        for item in items:
+            by_lang.setdefault(item.lang, []).append(item)
+
+        for lang, group in by_lang.items():
+            # Sort by length so similarly-sized sequences pad together, and
+            # split where a long outlier would force everything else in the
+            # batch to pad (and compute) up to its length
+            group.sort(key=lambda item: len(item.token_ids))
+            start = 0
+            for i in range(1, len(group) + 1):
+                if i < len(group) and len(group[i].token_ids) <= 2 * len(group[start].token_ids) + 16:
+                    continue
+                sub = group[start:i]
+                start = i
+                try:
+                    _run_batch(lang, sub)
+                except Exception as e:
+                    for item in sub:
+                        item.error = e
+                        item.event.set()
+
+
+def _predict_logits(lang, token_ids):
+    """Queue one sequence for the batching worker and wait for its logits."""
+    item = _BatchItem(lang, token_ids)
+    _batch_queue.put(item)
+    item.event.wait()
+    if item.error is not None:
+        raise item.error
+    return item.logits
+
+
+threading.Thread(target=_batch_worker, daemon=True, name='mlm-batch-worker').start()
+
+
+def _restrict_langdetect_profiles():
+    """Load only the langdetect profiles named in LANGDETECT_LANGUAGES.
+
+    langdetect materializes ~55 n-gram profiles (tens of MB of RSS) on
+    first use, but this server only branches en / es / other. Setting
+    e.g. LANGDETECT_LANGUAGES=en,es preloads a factory with just those
+    profiles; texts in other languages then fail detection and fall
+    through to the default model, which is where they routed anyway.
+    Opt-in, since subsetting changes which texts langdetect can score.
+    """
+    langs = os.environ.get('LANGDETECT_LANGUAGES', '')
+    if not langs:
+        return
+    try:
+        from langdetect import detector_factory
+        from langdetect.utils.lang_profile import LangProfile
+
+        wanted = [l.strip() for l in langs.split(',') if l.strip()]
+        factory = detector_factory.DetectorFactory()
+        for index, lang in enumerate(wanted):
+            path = os.path.join(detector_factory.PROFILES_DIRECTORY, lang)
+            with open(path, 'r', encoding='utf-8') as f:
+                factory.add_profile(LangProfile(**json.load(f)), index, len(wanted))
+        detector_factory._factory = factory
+        logger.info(f"langdetect restricted to profiles: {wanted}")
+    except Exception as e:
+        logger.warning(f"Could not restrict langdetect profiles: {e}")
+
+
+_restrict_langdetect_profiles()
+
+
+@functools.lru_cache(maxsize=2048)
 def detect_language(text):
+    """Cached language detection - pages resend identical text constantly,
+    so repeat lookups cost a dict probe instead of n-gram scoring."""
+    return _detect_language_impl(text)
+
+
+def _detect_language_impl(text):
     """Detect language of the text"""
     try:
         # Clean text for better detection (remove very short texts)
         clean_text = text.strip()
         if len(clean_text) < 3:
             return 'default'
-        
+
+        # Short pure-ASCII snippets are overwhelmingly English in practice
+        # (Spanish carries diacritics or punctuation outside ASCII on any
+        # non-trivial text); skip the pure-Python n-gram scorer for them
+        if len(clean_text) < 200 and clean_text.isascii():
+            return 'en'
+
         # Detect language
         lang = detect(clean_text)
         
@@ -97,25 +433,45 @@ def detect_language(text):
             return 'default'
             
     except LangDetectException:
-        logger.warning(f"Language detection failed for text: '{text[:50]}...'")
+        logger.warning("Language detection failed for text: '%.50s...'", text)
         return 'default'
     except Exception as e:
         logger.warning(f"Language detection error: {e}")
         return 'default'
 
+@functools.lru_cache(maxsize=4096)
+def _tokenize_cached(lang, text):
+    """Tokenize once per (model, text) pair - extension traffic repeats heavily.
+
+    Returns tuples so cached values can't be mutated by callers.
+    """
+    tokenizer = models[lang].tokenizer
+    tokens = tokenizer.tokenize(text)
+    return tuple(tokens), tuple(tokenizer.convert_tokens_to_ids(tokens))
+
+
+@functools.lru_cache(maxsize=4096)
+def _encode_with_offsets_cached(lang, text):
+    """Cached fast-tokenizer encode returning ids, char offsets and tokens."""
+    tokenizer = models[lang].tokenizer
+    enc = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+    return tuple(enc['input_ids']), tuple(enc['offset_mapping']), tuple(enc.tokens())
+
+
 def get_model_for_text(text):
     """Get the appropriate model and tokenizer for the given text"""
     lang = detect_language(text)
-    
-    # Check if the language-specific model is available
-    if models[lang]['model'] is not None:
-        logger.info(f"Using {lang} model ({models[lang]['name']}) for text: '{text[:30]}...'")
-        return models[lang]['model'], models[lang]['tokenizer'], lang
+
+    # Check if the language-specific model is available (loading it on
+    # first use if it wasn't part of the eager CHROMA_LANGS set)
+    if _ensure_loaded(lang):
+        logger.info("Using %s model (%s) for text: '%.30s...'", lang, models[lang].name, text)
+        return models[lang].model, models[lang].tokenizer, lang
     
     # Fallback to default model
-    if models['default']['model'] is not None:
-        logger.info(f"Using default model ({models['default']['name']}) for text: '{text[:30]}...'")
-        return models['default']['model'], models['default']['tokenizer'], 'default'
+    if _ensure_loaded('default'):
+        logger.info("Using default model (%s) for text: '%.30s...'", models['default'].name, text)
+        return models['default'].model, models['default'].tokenizer, 'default'
     
     # If no models available, raise error
     raise Exception("No models available")
@@ -128,87 +484,188 @@ def index():
 @app.route('/health')
 def health():
     """Health check endpoint"""
-    loaded_models = {lang: data['model'] is not None for lang, data in models.items()}
+    loaded_models = {lang: data.model is not None for lang, data in models.items()}
     
-    return jsonify({
+    return ojsonify({
         "status": "healthy",
         "models_loaded": loaded_models,
         "available_languages": list(loaded_models.keys()),
-        "model_names": {lang: data['name'] for lang, data in models.items() if data['model'] is not None}
+        "model_names": {lang: data.name for lang, data in models.items() if data.model is not None}
     })
 
+def _display_payload(detected_lang, text, token_ids, offsets, original_tokens):
+    """Build the /tokenize_display response dict for one already-encoded text."""
+    token_positions = []
+    for token, token_id, (start, end) in zip(original_tokens, token_ids, offsets):
+        if start == end:
+            continue  # zero-width artifacts (e.g. stray special pieces)
+        token_positions.append({
+            'token': text[start:end],
+            'token_id': token_id,
+            'start': start,
+            'end': end,
+            'original_token': token,
+            # Subword = glued onto the previous token with no whitespace
+            'is_subword': start > 0 and not text[start - 1].isspace(),
+            'has_space_prefix': False
+        })
+
+    return {
+        "success": True,
+        "text": text,
+        "reconstructed": text,
+        "match": True,
+        "token_count": len(token_positions),
+        "token_positions": token_positions,
+        "original_tokens": list(original_tokens),
+        "word_level": False,
+        "detected_language": detected_lang,
+        "model_used": models[detected_lang].name
+    }
+
 @app.route('/tokenize_display', methods=['POST'])
 def tokenize_display():
     """Tokenization optimized for display - properly handles punctuation and spacing"""
     try:
         data = request.get_json()
         text = data.get('text', '')
-        
+        texts = data.get('texts')
+
+        if texts:
+            # Batch path: group texts by language so each group is encoded
+            # in one tokenizer call - the Rust backend parallelizes across
+            # the list instead of paying a Python round trip per text
+            langs = [get_model_for_text(t)[2] for t in texts]
+            results = [None] * len(texts)
+            for lang in dict.fromkeys(langs):
+                indices = [i for i, l in enumerate(langs) if l == lang]
+                enc = models[lang].tokenizer(
+                    [texts[i] for i in indices],
+                    add_special_tokens=False, return_offsets_mapping=True
+                )
+                for row, i in enumerate(indices):
+                    results[i] = _display_payload(
+                        lang, texts[i],
+                        enc['input_ids'][row], enc['offset_mapping'][row], enc.tokens(row)
+                    )
+            return ojsonify({"success": True, "results": results})
+
         if not text:
-            return jsonify({"error": "No text provided"}), 400
-        
+            return ojsonify({"error": "No text provided"}, status=400)
+
         # Get appropriate model for this text
         mlm_model, mlm_tokenizer, detected_lang = get_model_for_text(text)
-        
-        # Use the MLM tokenizer for consistent tokenization
-        tokens = mlm_tokenizer.tokenize(text)
-        token_ids = mlm_tokenizer.convert_tokens_to_ids(tokens)
-        
-        # Get the reconstructed text using the tokenizer's native method
-        reconstructed = mlm_tokenizer.convert_tokens_to_string(tokens)
-        
-        # Create token positions by mapping back to the reconstructed text
-        token_positions = []
-        current_pos = 0
-        
-        for i, token in enumerate(tokens):
-            # Clean the token for display
-            if token.startswith('##'):  # BERT subword format
-                clean_token = token[2:]  # Remove ##
-                is_subword = True
-            elif token.startswith('Ġ'):  # RoBERTa format
-                clean_token = ' ' + token[1:]  # Replace Ġ with space
-                is_subword = False
-            elif token.startswith('▁'):  # SentencePiece format
-                clean_token = token[1:]  # Remove ▁
-                is_subword = False
-            else:
-                clean_token = token
-                is_subword = False
-            
-            # Find this token in the reconstructed text
-            if clean_token:
-                # Simple token search - no special space handling needed
-                start_pos = reconstructed.find(clean_token, current_pos)
-                if start_pos != -1:
-                    end_pos = start_pos + len(clean_token)
-                    token_positions.append({
-                        'token': clean_token,
-                        'token_id': token_ids[i],
-                        'start': start_pos,
-                        'end': end_pos,
-                        'original_token': token,
-                        'is_subword': is_subword,
-                        'has_space_prefix': False
-                    })
-                    current_pos = end_pos
-        
-        return jsonify({
-            "success": True,
-            "text": text,
-            "reconstructed": reconstructed,
-            "match": text.strip() == reconstructed.strip(),
-            "token_count": len(token_positions),
-            "token_positions": token_positions,
-            "original_tokens": tokens,
-            "word_level": False,
-            "detected_language": detected_lang,
-            "model_used": models[detected_lang]['name']
-        })
-        
+
+        # The fast tokenizer reports exact char spans in one pass - no
+        # reconstructed string to rebuild and no find() scanning per token
+        token_ids, offsets, original_tokens = _encode_with_offsets_cached(detected_lang, text)
+
+        return ojsonify(_display_payload(detected_lang, text, token_ids, offsets, original_tokens))
+
     except Exception as e:
         logger.error(f"Tokenization error: {e}")
-        return jsonify({"error": str(e)}), 500
+        return ojsonify({"error": str(e)}, status=500)
+
+def _predict_masked(detected_lang, mlm_tokenizer, tokens, token_ids, masked_positions):
+    """Core MLM prediction shared by /predict_tokens and /tokenize_and_predict.
+
+    Takes an already-tokenized text, masks the requested positions, runs one
+    forward pass through the micro-batcher and returns the per-position
+    prediction dicts.
+    """
+    # Clamp long inputs to the model's context window instead of letting
+    # position embeddings index out of range; keep the window centered on
+    # the first masked position so its surrounding context survives the cut
+    window_start = 0
+    max_len = int(getattr(mlm_tokenizer, 'model_max_length', 512) or 512)
+    if max_len > 4096:  # some tokenizers report a huge sentinel value
+        max_len = 512
+    budget = max_len - 2  # room for the special tokens added below
+    if len(token_ids) > budget:
+        # Truncate even with no masked positions - the forward still runs
+        # and would index position embeddings out of range otherwise
+        center = min(masked_positions) if masked_positions else 0
+        window_start = max(0, min(center - budget // 2, len(token_ids) - budget))
+        tokens = tokens[window_start:window_start + budget]
+        token_ids = token_ids[window_start:window_start + budget]
+        masked_positions = [pos - window_start for pos in masked_positions]
+        logger.info("Truncated input to a %d-token window starting at token %d", budget, window_start)
+
+    # Build the masked id sequence directly - the forward pass only needs
+    # ids, and the parallel token-string copies existed solely for a log
+    # line. One special token on each side for both tokenizer families.
+    special_offset = 1
+    if hasattr(mlm_tokenizer, 'bos_token') and mlm_tokenizer.bos_token:
+        masked_token_ids = [mlm_tokenizer.bos_token_id, *token_ids, mlm_tokenizer.eos_token_id]
+    else:
+        # For BERT models, use CLS and SEP
+        masked_token_ids = [mlm_tokenizer.cls_token_id, *token_ids, mlm_tokenizer.sep_token_id]
+
+    seq_len = len(masked_token_ids)
+    for pos in masked_positions:
+        if 0 <= pos + special_offset < seq_len:
+            masked_token_ids[pos + special_offset] = mlm_tokenizer.mask_token_id
+
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Masked token ids: %s", masked_token_ids)
+
+    # Run through the micro-batcher so concurrent requests share one
+    # padded forward pass
+    predictions = _predict_logits(detected_lang, masked_token_ids)  # [seq_len, vocab_size]
+
+    # Gather all masked rows at once, then run softmax and top-k as one
+    # batched kernel each instead of re-running a full-vocab softmax for
+    # every candidate of every position
+    valid = [
+        (pos, pos + special_offset)
+        for pos in masked_positions
+        if 0 <= pos + special_offset < seq_len
+    ]
+
+    results = []
+    if valid:
+        row_positions = torch.tensor([adj for _, adj in valid])
+        # Upcast once before the exp/logsumexp math: FP16 logits overflow
+        # exp() easily and lose low-probability mass to rounding. Only the
+        # gathered masked rows pay for the wider dtype, not the full output
+        mask_logits = predictions[row_positions].float()  # [num_masked, vocab]
+        topk = torch.topk(mask_logits, k=5, dim=-1)
+        # Top-k order is unchanged by softmax, so normalize only the
+        # handful of entries we return: one fused logsumexp reduction
+        # per row instead of materializing a full probability tensor
+        log_norm = torch.logsumexp(mask_logits, dim=-1, keepdim=True)
+        topk_probs = torch.exp(topk.values - log_norm)
+        original_ids = torch.tensor([token_ids[pos] for pos, _ in valid])
+        original_logits = mask_logits[torch.arange(len(valid)), original_ids]
+        original_probs = torch.exp(original_logits - log_norm.squeeze(-1))
+
+        # Three bulk transfers instead of a device sync per .item() call -
+        # each .item() on a GPU tensor is a blocking round trip
+        topk_id_rows = topk.indices.cpu().tolist()
+        topk_prob_rows = topk_probs.cpu().tolist()
+        original_prob_list = original_probs.cpu().tolist()
+        id_to_token = models[detected_lang].id_to_token
+
+        for row, (pos, adjusted_pos) in enumerate(valid):
+            predictions_list = []
+            for token_id, probability in zip(topk_id_rows[row], topk_prob_rows[row]):
+                token_text = id_to_token[token_id]
+
+                predictions_list.append({
+                    'token': token_text,
+                    'token_id': token_id,
+                    'probability': probability
+                })
+
+            results.append({
+                'position': pos + window_start,  # report caller-relative positions
+                'original_token': tokens[pos],
+                'original_probability': original_prob_list[row],
+                'predictions': predictions_list
+            })
+
+    logger.info("Generated %d predictions", len(results))
+    return results
 
 @app.route('/predict_tokens', methods=['POST'])
 def predict_tokens():
@@ -217,174 +674,144 @@ def predict_tokens():
         data = request.get_json()
         text = data.get('text', '')
         masked_positions = data.get('masked_positions', [])
-        
+
         if not text:
-            return jsonify({"error": "No text provided"}), 400
-        
+            return ojsonify({"error": "No text provided"}, status=400)
+
         # Get appropriate model for this text (same as tokenize_display)
         mlm_model, mlm_tokenizer, detected_lang = get_model_for_text(text)
-        
-        logger.info(f"Predicting tokens for text: '{text[:50]}...' at positions: {masked_positions} using {detected_lang} model")
-        
-        # Use the MLM tokenizer for consistent tokenization
-        tokens = mlm_tokenizer.tokenize(text)
-        token_ids = mlm_tokenizer.convert_tokens_to_ids(tokens)
-        
-        logger.info(f"Tokenized into {len(tokens)} tokens: {tokens[:10]}...")
-        
-        # Add special tokens for proper MLM prediction
-        # Check if tokenizer has BOS/EOS tokens
-        if hasattr(mlm_tokenizer, 'bos_token') and mlm_tokenizer.bos_token:
-            tokens_with_special = [mlm_tokenizer.bos_token] + tokens + [mlm_tokenizer.eos_token]
-            token_ids_with_special = [mlm_tokenizer.bos_token_id] + token_ids + [mlm_tokenizer.eos_token_id]
-            special_offset = 1
-        else:
-            # For BERT models, use CLS and SEP
-            tokens_with_special = [mlm_tokenizer.cls_token] + tokens + [mlm_tokenizer.sep_token]
-            token_ids_with_special = [mlm_tokenizer.cls_token_id] + token_ids + [mlm_tokenizer.sep_token_id]
-            special_offset = 1
-        
-        # Adjust masked positions to account for the added special token
-        adjusted_positions = [pos + special_offset for pos in masked_positions]
-        
-        # Create masked input
-        masked_tokens = tokens_with_special.copy()
-        masked_token_ids = token_ids_with_special.copy()
-        
-        for pos in adjusted_positions:
-            if 0 <= pos < len(masked_tokens):
-                masked_tokens[pos] = mlm_tokenizer.mask_token
-                masked_token_ids[pos] = mlm_tokenizer.mask_token_id
-        
-        logger.info(f"Masked tokens: {masked_tokens}")
-        
-        # Convert to tensor and predict
-        input_ids = torch.tensor([masked_token_ids])
-        
-        with torch.no_grad():
-            outputs = mlm_model(input_ids)
-            predictions = outputs.logits[0]  # Shape: [seq_len, vocab_size]
-        
-        # Get predictions for each masked position
-        results = []
-        for i, pos in enumerate(masked_positions):
-            adjusted_pos = pos + special_offset  # Account for special token
-            if 0 <= adjusted_pos < len(tokens_with_special):
-                # Get top predictions for this position
-                position_logits = predictions[adjusted_pos]
-                top_indices = torch.topk(position_logits, k=5).indices
-                
-                # Get probability of the original token
-                original_token_id = token_ids[pos]
-                original_probability = torch.softmax(position_logits, dim=0)[original_token_id].item()
-                
-                predictions_list = []
-                for idx in top_indices:
-                    token_id = idx.item()
-                    token_text = mlm_tokenizer.convert_ids_to_tokens([token_id])[0]
-                    probability = torch.softmax(position_logits, dim=0)[idx].item()
-                    
-                    predictions_list.append({
-                        'token': token_text,
-                        'token_id': token_id,
-                        'probability': probability
-                    })
-                
-                results.append({
-                    'position': pos,
-                    'original_token': tokens[pos],
-                    'original_probability': original_probability,
-                    'predictions': predictions_list
-                })
-        
-        logger.info(f"Generated {len(results)} predictions")
-        
-        return jsonify({
+
+        logger.info("Predicting tokens for text: '%.50s...' at positions: %s using %s model", text, masked_positions, detected_lang)
+
+        # Use the MLM tokenizer for consistent tokenization (memoized)
+        tokens, token_ids = _tokenize_cached(detected_lang, text)
+        tokens, token_ids = list(tokens), list(token_ids)
+
+        logger.info("Tokenized into %d tokens: %s...", len(tokens), tokens[:10])
+
+        results = _predict_masked(detected_lang, mlm_tokenizer, tokens, token_ids, masked_positions)
+
+        return ojsonify({
             "success": True,
             "text": text,
             "original_tokens": tokens,
             "predictions": results,
             "detected_language": detected_lang,
-            "model_used": models[detected_lang]['name']
+            "model_used": models[detected_lang].name
         })
-        
+
     except Exception as e:
         logger.error(f"Prediction error: {e}", exc_info=True)
-        return jsonify({"error": str(e)}), 500
+        return ojsonify({"error": str(e)}, status=500)
+
+@app.route('/tokenize_and_predict', methods=['POST'])
+def tokenize_and_predict():
+    """Fused tokenize + predict: one round trip, one tokenization, one forward.
+
+    The extension previously called /tokenize_display and /predict_tokens
+    back to back for every hover, tokenizing the same context twice. This
+    endpoint accepts the display token index directly, resolves it to the
+    original token position server-side and returns both payloads at once.
+    """
+    try:
+        data = request.get_json()
+        text = data.get('text', '')
+        token_index = data.get('token_index')
+        masked_positions = data.get('masked_positions', [])
+
+        if not text:
+            return ojsonify({"error": "No text provided"}, status=400)
+
+        mlm_model, mlm_tokenizer, detected_lang = get_model_for_text(text)
+
+        token_ids, offsets, original_tokens = _encode_with_offsets_cached(detected_lang, text)
+        tokens, token_ids = list(original_tokens), list(token_ids)
+
+        # Same span walk that serves /tokenize_display - build the display
+        # payload once and graft the predictions onto it
+        payload = _display_payload(detected_lang, text, token_ids, offsets, original_tokens)
+        token_positions = payload['token_positions']
+
+        # Resolve a display token index to its position in the original
+        # token list (this matching used to live in the extension)
+        if token_index is not None and 0 <= token_index < len(token_positions):
+            target = token_positions[token_index]['original_token']
+            for i, token in enumerate(tokens):
+                if token == target:
+                    masked_positions = [i]
+                    break
+
+        payload['predictions'] = _predict_masked(
+            detected_lang, mlm_tokenizer, tokens, token_ids, masked_positions)
+
+        return ojsonify(payload)
+
+    except Exception as e:
+        logger.error(f"Fused tokenize/predict error: {e}", exc_info=True)
+        return ojsonify({"error": str(e)}, status=500)
 
 @app.route('/test')
 def test():
     """Test endpoint with sample text"""
     test_text = "Click the extension icon in your toolbar"
-    return jsonify(tokenize_display_text(test_text))
+    return ojsonify(tokenize_display_text(test_text))
 
 @app.route('/test_mlm')
 def test_mlm():
     """Test MLM endpoint with sample text"""
-    if not mlm_model:
-        return jsonify({"error": "MLM model not loaded"}), 500
-    
     test_text = "Click the extension icon in your toolbar"
     test_positions = [0]  # Position of first word
-    
-    return jsonify(predict_tokens_for_test(test_text, test_positions))
+
+    return ojsonify(predict_tokens_for_test(test_text, test_positions))
 
 def tokenize_display_text(text):
     """Helper function for display tokenization"""
-    if not mlm_tokenizer:
-        return {"error": "Tokenizer not loaded"}
-    
-    # Get real tokenization
-    token_ids = mlm_tokenizer.encode(text, add_special_tokens=False)
-    token_strings = mlm_tokenizer.convert_ids_to_tokens(token_ids)
-    
-    # Split into words (including spaces)
-    import re
-    words = re.findall(r'\S+', text)  # Only words, no spaces
-    
-    # Create display tokens
+    mlm_model, mlm_tokenizer, detected_lang = get_model_for_text(text)
+
+    # One fast-tokenizer call returns ids plus char offsets; walking the
+    # offsets linearly replaces the old O(words x tokens) startswith scan
+    enc = mlm_tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+    token_ids = enc['input_ids']
+    offsets = enc['offset_mapping']
+
+    # Group consecutive tokens into whitespace-delimited words; the first
+    # token of each word supplies the word's display ID
     display_tokens = []
     display_token_ids = []
-    
-    # For each word, find its token ID
-    token_idx = 0
-    for word in words:
-        # Find the first token that starts this word
-        word_token_id = None
-        
-        for i in range(token_idx, len(token_strings)):
-            token_str = token_strings[i]
-            
-            # Clean token string
-            clean_token = token_str.replace('##', '')
-            
-            if word.startswith(clean_token):
-                word_token_id = token_ids[i]
-                break
-        
-        if word_token_id is None:
-            # Fallback - use position-based ID
-            word_token_id = len(display_tokens) + 1
-        
-        display_tokens.append(word)
-        display_token_ids.append(word_token_id)
-    
+    word_start = None
+    word_first_id = None
+    prev_end = None
+    for tid, (start, end) in zip(token_ids, offsets):
+        if start == end:
+            continue
+        if word_start is None or start > prev_end:
+            # Whitespace gap before this token - previous word is complete
+            if word_start is not None:
+                display_tokens.append(text[word_start:prev_end])
+                display_token_ids.append(word_first_id)
+            word_start = start
+            word_first_id = tid
+        prev_end = end
+    if word_start is not None:
+        display_tokens.append(text[word_start:prev_end])
+        display_token_ids.append(word_first_id)
+
     # Add spaces back between words
     final_tokens = []
     final_token_ids = []
-    
+
     for i, word in enumerate(display_tokens):
         final_tokens.append(word)
         final_token_ids.append(display_token_ids[i])
-        
+
         # Add space after word (except last)
         if i < len(display_tokens) - 1:
             final_tokens.append(' ')
             final_token_ids.append(-1)  # Special ID for spaces
-    
+
     # Reconstruction
     reconstructed = ''.join(final_tokens)
-    
+
     return {
         "text": text,
         "token_ids": final_token_ids,
@@ -396,53 +823,35 @@ def tokenize_display_text(text):
     }
 
 def predict_tokens_for_test(text, positions):
-    """Helper function for MLM testing"""
-    if not mlm_model or not mlm_tokenizer:
-        return {"error": "MLM model not loaded"}
-    
-    tokens = mlm_tokenizer.tokenize(text)
-    masked_tokens = tokens.copy()
-    
+    """Helper function for MLM testing - thin wrapper over _predict_masked.
+
+    Kept as a separate entry point for /test_mlm, but the tokenization,
+    forward pass and top-k math all go through the same code that serves
+    /predict_tokens instead of a drifting single-model copy.
+    """
+    mlm_model, mlm_tokenizer, detected_lang = get_model_for_text(text)
+    tokens, token_ids = _tokenize_cached(detected_lang, text)
+    tokens, token_ids = list(tokens), list(token_ids)
+
+    masked_tokens = list(tokens)
     for pos in positions:
         if 0 <= pos < len(masked_tokens):
             masked_tokens[pos] = mlm_tokenizer.mask_token
-    
-    masked_text = mlm_tokenizer.convert_tokens_to_string(masked_tokens)
-    inputs = mlm_tokenizer(masked_text, return_tensors="pt")
-    
-    with torch.no_grad():
-        outputs = mlm_model(**inputs)
-        predictions = F.softmax(outputs.logits, dim=-1)
-    
-    results = []
-    for pos in positions:
-        if 0 <= pos < len(tokens):
-            top_predictions = torch.topk(predictions[0, pos+1], 3)
-            
-            predictions_list = []
-            for j in range(3):
-                token_id = top_predictions.indices[j].item()
-                probability = top_predictions.values[j].item()
-                token_text = mlm_tokenizer.decode([token_id])
-                
-                predictions_list.append({
-                    'token': token_text,
-                    'probability': probability
-                })
-            
-            results.append({
-                'position': pos,
-                'original_token': tokens[pos],
-                'predictions': predictions_list
-            })
-    
+
+    results = _predict_masked(detected_lang, mlm_tokenizer, tokens, token_ids, positions)
+
     return {
         "text": text,
-        "masked_text": masked_text,
+        "masked_text": mlm_tokenizer.convert_tokens_to_string(masked_tokens),
         "predictions": results
     }
 
 if __name__ == '__main__':
+    # Pin the intra-op thread pool before any forward runs so BLAS
+    # throughput is stable instead of oversubscribing alongside the
+    # request threads
+    torch.set_num_threads(max(1, (os.cpu_count() or 2) // 2))
+
     # Load models on startup
     if load_models():
         logger.info("🚀 Starting tokenizer server...")
@@ -452,7 +861,14 @@ if __name__ == '__main__':
         logger.info("  - Display tokenize: http://localhost:5001/tokenize_display")
         logger.info("  - Predict tokens: http://localhost:5001/predict_tokens")
         logger.info("  - Test MLM: http://localhost:5001/test_mlm")
-        app.run(host='0.0.0.0', port=5001, debug=True)
+        # Flask's debug server is single-threaded and the reloader runs the
+        # whole module (and model loads) twice; serve with waitress instead
+        try:
+            from waitress import serve
+            serve(app, host='0.0.0.0', port=5001, threads=8)
+        except ImportError:
+            logger.warning("waitress not installed, falling back to Flask dev server")
+            app.run(host='0.0.0.0', port=5001, debug=False, use_reloader=False)
     else:
         logger.error("Failed to load models. Exiting.")
         exit(1)